@@ -7,9 +7,10 @@ import numba
 import numpy as np
 
 from .cayley_graph import CayleyGraph
-from .permutation_utils import is_permutation
+from .permutation_utils import inverse_permutation, is_permutation
 
 R = 8  # Chunk prefix size.
+ALPHA = 4  # Use bottom-up step when the last layer is larger than 1/ALPHA of unvisited vertices.
 CHUNK_SIZE = math.factorial(R)
 PREFIX_MAP_1 = np.zeros((CHUNK_SIZE,), dtype=np.int32)  # Maps prefix id to encoded permutation.
 PREFIX_MAP_2 = np.zeros((2 ** (3 * R)), dtype=np.int32)  # Maps encoded permutation to prefix id.
@@ -81,6 +82,14 @@ def _paint_gray(perms, gray, map2):
         gray[rank // 64] |= 1 << (rank % 64)
 
 
+@numba.njit("(b1[:],i8[:],i4[:],u8[:,:],i8[:,:])")
+def _test_last_layer(ans, perms, chunk_ids, last_layers, maps2):
+    for i in range(len(perms)):
+        chunk_id = chunk_ids[perms[i] >> (4 * R)]
+        rank = permutation_to_rank(perms[i], maps2[chunk_id])
+        ans[i] = ((last_layers[chunk_id, rank // 64] >> (rank % 64)) & 1) == 1
+
+
 def _encode_perm(p):
     return sum(p[i] << (4 * i) for i in range(len(p)))
 
@@ -115,6 +124,13 @@ class VertexChunk:
         _materialize_permutations(ans, self.last_layer, self.map1)
         return ans
 
+    # Returns array of explicit permutations for vertices in this chunk that were not visited yet.
+    def materialize_unvisited_permutations(self):
+        unvisited = ~self.black
+        ans = np.full((_bit_count(unvisited),), self.encoded_suffix, dtype=np.int64)
+        _materialize_permutations(ans, unvisited, self.map1)
+        return ans
+
     # Paints vertices of given ranks gray.
     # Vertices outside of this chunk are ignored.
     def paint_gray(self, perms):
@@ -150,6 +166,12 @@ class CayleyGraphChunkedBfs:
         assert len(self.chunks) == chunks_num
         self.suffix_mask = (2 ** (4 * (n - R)) - 1) << (4 * R)
 
+        # Tables to find chunk containing given permutation, used by bottom-up step.
+        self.chunk_ids = np.zeros((2 ** (4 * (n - R)),), dtype=np.int32)
+        for i, c in enumerate(self.chunks):
+            self.chunk_ids[c.encoded_suffix >> (4 * R)] = i
+        self.maps2 = np.stack([c.map2 for c in self.chunks])
+
         # Prepare functions to compute permutations.
         assert is_permutation(graph.definition.central_state), "This version of BFS works only for permutations."
         perms = graph.generators
@@ -157,6 +179,14 @@ class CayleyGraphChunkedBfs:
         assert enc is not None
         perm_funcs = [enc.implement_permutation_1d(p) for p in perms]
         self.perm_funcs = [numba.njit("i8[:](i8[:])")(f) for f in perm_funcs]
+        self.inv_perm_funcs = []
+        perms_list = [list(p) for p in perms]
+        for p in perms_list:
+            inv = inverse_permutation(p)
+            if inv in perms_list:
+                self.inv_perm_funcs.append(self.perm_funcs[perms_list.index(inv)])
+            else:
+                self.inv_perm_funcs.append(numba.njit("i8[:](i8[:])")(enc.implement_permutation_1d(inv)))
 
     def paint_gray(self, perms):
         if len(perms) == 1:
@@ -171,6 +201,36 @@ class CayleyGraphChunkedBfs:
         i1 = group_starts[-1]
         self.chunk_map[keys[i1]].paint_gray(perms[i1:])
 
+    def step_top_down(self):
+        """Paints gray all neighbors of the last layer."""
+        for c1 in self.chunks:
+            if not c1.changed_on_last_step:
+                continue
+            perms = c1.materialize_last_layer_permutations()
+            neighbors = np.hstack([p(perms) for p in self.perm_funcs])
+            self.paint_gray(neighbors)
+
+    def step_bottom_up(self):
+        """Paints gray all unvisited vertices that have a neighbor in the last layer.
+
+        For each unvisited vertex v, checks whether g^-1(v) is in the last layer for some generator g. Vertices
+        for which such generator was found are not checked against the remaining generators.
+        Temporarily uses one extra bit of memory per vertex to store a copy of the last layer.
+        """
+        last_layers = np.stack([c.last_layer for c in self.chunks])
+        for c1 in self.chunks:
+            perms = c1.materialize_unvisited_permutations()
+            found = []
+            for inv_perm_func in self.inv_perm_funcs:
+                if len(perms) == 0:
+                    break
+                mask = np.zeros((len(perms),), dtype=np.bool_)
+                _test_last_layer(mask, inv_perm_func(perms), self.chunk_ids, last_layers, self.maps2)
+                found.append(perms[mask])
+                perms = perms[~mask]
+            if sum(len(x) for x in found) > 0:
+                c1.paint_gray(np.hstack(found))
+
     def flush_gray_to_black(self):
         for c in self.chunks:
             c.flush_gray_to_black()
@@ -178,23 +238,23 @@ class CayleyGraphChunkedBfs:
     def count_last_layer(self):
         return sum(c.last_layer_count for c in self.chunks)
 
-    def bfs(self, max_diameter=10**6):
+    def bfs(self, max_diameter=10**6, direction_optimizing=True):
         initial_states = np.array([_encode_perm(self.graph.definition.central_state)], dtype=np.int64)
         self.paint_gray(initial_states)
         self.flush_gray_to_black()
         layer_sizes = [self.count_last_layer()]
+        graph_size = len(self.chunks) * CHUNK_SIZE
 
         for i in range(1, max_diameter + 1):
-            chunks_used = 0
-            for c1 in self.chunks:
-                if not c1.changed_on_last_step:
-                    continue
-                perms = c1.materialize_last_layer_permutations()
-                neighbors = np.hstack([p(perms) for p in self.perm_funcs])
-                self.paint_gray(neighbors)
-                chunks_used += 1
-            if chunks_used == 0:
-                break
+            # Direction-optimizing BFS, see Beamer et al., "Direction-Optimizing Breadth-First Search" (2012).
+            # Unlike there, we don't need a separate condition to switch back to top-down, because number of unvisited
+            # vertices only decreases. Value of ALPHA was picked empirically on LRX, pancake and transpositions graphs.
+            unvisited_size = graph_size - sum(layer_sizes)
+            bottom_up = direction_optimizing and layer_sizes[-1] * ALPHA > unvisited_size
+            if bottom_up:
+                self.step_bottom_up()
+            else:
+                self.step_top_down()
             self.flush_gray_to_black()
 
             layer_size = self.count_last_layer()
@@ -202,17 +262,19 @@ class CayleyGraphChunkedBfs:
                 break
             layer_sizes.append(layer_size)
             if self.graph.verbose >= 2:
-                print(f"Layer {i} - size {layer_size}.")
+                print(f"Layer {i} - size {layer_size}" + (" (bottom-up)." if bottom_up else "."))
         return layer_sizes
 
 
-def bfs_bitmask(graph: CayleyGraph, max_diameter: int = 10**6) -> list[int]:
+def bfs_bitmask(graph: CayleyGraph, max_diameter: int = 10**6, direction_optimizing: bool = True) -> list[int]:
     """Version of BFS storing all vertices explicitly as bitmasks, using 3 bits of memory per state.
 
     See https://www.kaggle.com/code/fedimser/memory-efficient-bfs-on-caley-graphs-3bits-per-vx
 
     :param graph: Cayley graph for which to compute growth function.
     :param max_diameter:  maximal number of BFS iterations.
+    :param direction_optimizing: whether to switch to bottom-up steps (checking unvisited vertices for neighbors in
+           the last layer) when the last layer is large compared to the number of unvisited vertices.
     :return: Growth function (layer sizes).
     """
     n = graph.definition.state_size
@@ -220,4 +282,4 @@ def bfs_bitmask(graph: CayleyGraph, max_diameter: int = 10**6) -> list[int]:
     if graph.verbose >= 2:
         estimated_memory_gb = (math.factorial(n) * 3 / 8) / (2**30)
         print(f"Estimated memory usage: {estimated_memory_gb:.02f}GB.")
-    return CayleyGraphChunkedBfs(graph).bfs(max_diameter=max_diameter)
+    return CayleyGraphChunkedBfs(graph).bfs(max_diameter=max_diameter, direction_optimizing=direction_optimizing)
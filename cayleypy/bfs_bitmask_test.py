@@ -20,6 +20,8 @@ def test_bfs_bitmask_lrx_10():
 
 
 @pytest.mark.skipif(FAST_RUN, reason="slow test")
-def test_bfs_bitmask_pancake_9():
+@pytest.mark.parametrize("direction_optimizing", [False, True])
+def test_bfs_bitmask_pancake_9(direction_optimizing: bool):
     graph = CayleyGraph(PermutationGroups.pancake(9))
-    assert bfs_bitmask(graph) == load_dataset("pancake_cayley_growth")["9"]
+    result = bfs_bitmask(graph, direction_optimizing=direction_optimizing)
+    assert result == load_dataset("pancake_cayley_growth")["9"]
@@ -1,9 +1,105 @@
 """Special BFS algorithms, optimized for low memory usage."""
 
+from typing import Callable
+
+import numba
 import numpy as np
 
 from .cayley_graph import CayleyGraph
 from .permutation_utils import inverse_permutation
+from .string_encoder import StringEncoder
+
+# Compiling a permutation with Numba takes about 0.1s, which pays off only when it is applied to many states. So we
+# compile permutations only when BFS reaches layer of this size, and keep them for subsequent BFS runs.
+_NUMBA_MIN_LAYER_SIZE = 2**22
+_compiled_permutations: dict[tuple[int, int, tuple[int, ...]], Callable[[np.ndarray], np.ndarray]] = {}
+
+
+# Kernels are compiled on first use rather than at import, so importing cayleypy stays fast.
+@numba.njit(inline="always")
+def _hash_state(x):
+    # Finalizer of splitmix64, see https://prng.di.unimi.it/splitmix64.c
+    z = np.uint64(x)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+@numba.njit
+def _insert_batch(tags, keys, states, new_mask, start, max_size):
+    # Inserts states starting from `start` until table contains `max_size` states.
+    # Returns index of first state that was not processed and number of added states.
+    # Probes are done sequentially, because Numba has no atomic compare-and-swap to insert from parallel threads.
+    cap_mask = np.uint64(len(keys) - 1)
+    new_count = 0
+    for i in range(start, len(states)):
+        h = _hash_state(states[i])
+        idx = h & cap_mask
+        tag = np.uint8((h >> np.uint64(57)) + np.uint64(1))  # Between 1 and 128, 0 means empty slot.
+        while True:
+            if tags[idx] == 0:
+                if new_count == max_size:
+                    return i, new_count
+                tags[idx] = tag
+                keys[idx] = states[i]
+                new_mask[i] = True
+                new_count += 1
+                break
+            if tags[idx] == tag and keys[idx] == states[i]:
+                new_mask[i] = False
+                break
+            idx = (idx + np.uint64(1)) & cap_mask
+    return len(states), new_count
+
+
+class _StatesHashSet:
+    """Set of states encoded by single int64, implemented as open-addressing hash table.
+
+    Every slot has a one-byte tag (derived from the top bits of the hash), which is checked before the key itself.
+    Capacity is always a power of two, and the table is grown to keep load factor at most 1/2. Growth happens only
+    when the table actually gets half full, inserted batches (which often consist mostly of states that are already
+    in the set) don't need to fit in the table in advance.
+    """
+
+    def __init__(self, capacity: int = 1):
+        self.size = 0
+        self.tags = np.zeros((0,), dtype=np.uint8)
+        self.keys = np.zeros((0,), dtype=np.int64)
+        self._reserve(capacity)
+
+    def _reserve(self, capacity: int):
+        new_capacity = 1 << max(4, (2 * capacity - 1).bit_length())
+        if new_capacity <= len(self.keys):
+            return
+        old_keys = self.keys[self.tags != 0]
+        self.tags = np.zeros((new_capacity,), dtype=np.uint8)
+        self.keys = np.zeros((new_capacity,), dtype=np.int64)
+        _insert_batch(self.tags, self.keys, old_keys, np.zeros((len(old_keys),), dtype=np.bool_), 0, len(old_keys))
+
+    def insert(self, states: np.ndarray) -> np.ndarray:
+        """Adds states to the set. Returns mask of states that were not in the set before (first occurrences)."""
+        new_mask = np.zeros((len(states),), dtype=np.bool_)
+        start = 0
+        while True:
+            max_new = len(self.keys) // 2 - self.size
+            start, new_count = _insert_batch(self.tags, self.keys, states, new_mask, start, max_new)
+            self.size += new_count
+            if start == len(states):
+                return new_mask
+            self._reserve(self.size + 1)
+
+
+def _get_compiled_permutations(
+    encoder: StringEncoder, perms: list[list[int]], compile_missing: bool
+) -> list[Callable[[np.ndarray], np.ndarray]]:
+    """Returns Numba-compiled permutations, or empty list if they are not compiled yet and `compile_missing=False`."""
+    keys = [(encoder.w, encoder.n, tuple(p)) for p in perms]
+    if not compile_missing and not all(key in _compiled_permutations for key in keys):
+        return []
+    for key, p in zip(keys, perms):
+        if key not in _compiled_permutations:
+            _compiled_permutations[key] = numba.njit("i8[:](i8[:])")(encoder.implement_permutation_1d(p))
+    return [_compiled_permutations[key] for key in keys]
 
 
 def bfs_numpy(graph: CayleyGraph, max_diameter: int = 1000000) -> list[int]:
@@ -11,8 +107,11 @@ def bfs_numpy(graph: CayleyGraph, max_diameter: int = 1000000) -> list[int]:
     assert graph.definition.generators_inverse_closed, "Only supports undirected graph."
     assert graph.string_encoder is not None
     assert graph.string_encoder.encoded_length == 1, "Only works on states encoded by single int64."
+    encoder = graph.string_encoder
     perms = [list(x) for x in graph.generators]
-    perm_funcs = [graph.string_encoder.implement_permutation_1d(p) for p in perms]
+    perm_funcs = _get_compiled_permutations(encoder, perms, False)
+    if len(perm_funcs) == 0:
+        perm_funcs = [encoder.implement_permutation_1d(p) for p in perms]
     pn = len(perms)
     start_state_tensor = graph.encode_states(graph.central_state).cpu().numpy().reshape(-1)
     start_state = np.array(start_state_tensor, dtype=np.int64)
@@ -24,29 +123,31 @@ def bfs_numpy(graph: CayleyGraph, max_diameter: int = 1000000) -> list[int]:
         assert len(inv) == 1
         inv_perm_idx.append(inv[0])
 
-    def _make_states_unique(layer):
-        for i1 in range(pn):
-            for i2 in range(i1 + 1, pn):
-                layer[i1] = np.setdiff1d(layer[i1], layer[i2], assume_unique=True)
-
+    # Layers are stored as lists of pn arrays, where i-th array contains states obtained by i-th permutation.
     layer0 = [start_state] * pn
-    layer1 = [perm_funcs[i](start_state) for i in range(pn)]
-    layer1 = [np.setdiff1d(x, start_state, assume_unique=True) for x in layer1]
-    _make_states_unique(layer1)
-    layer_sizes = [1, len(np.unique(np.hstack(layer1)))]
+    visited = _StatesHashSet(pn + 1)
+    visited.insert(start_state)
+    layer1 = []
+    for i1 in range(pn):
+        states = perm_funcs[i1](start_state)
+        layer1.append(states[visited.insert(states)])
+    layer_sizes = [1, sum(len(x) for x in layer1)]
 
     for i in range(2, max_diameter + 1):
+        # Only two last layers are needed to find new states, because the graph is undirected.
+        layer1_size = sum(len(x) for x in layer1)
+        if layer1_size >= _NUMBA_MIN_LAYER_SIZE:
+            perm_funcs = _get_compiled_permutations(encoder, perms, True)
+        visited = _StatesHashSet(layer_sizes[-2] + 2 * layer1_size)
+        for states in layer0 + layer1:
+            visited.insert(states)
         layer2 = []
         for i1 in range(pn):
             # All states where we can go from layer1 by permutation i1 (except those that are in layer0).
             next_group = [perm_funcs[i1](layer1[i2]) for i2 in range(pn) if i2 != inv_perm_idx[i1]]
             states = np.hstack(next_group)
-            states = np.sort(states)
-            for i2 in range(pn):
-                states = np.setdiff1d(states, layer0[i2], assume_unique=True)
-                states = np.setdiff1d(states, layer1[i2], assume_unique=True)
-            layer2.append(states)
-        _make_states_unique(layer2)
+            layer2.append(states[visited.insert(states)])
+        del visited
         layer2_size = sum(len(x) for x in layer2)
         if layer2_size == 0:
             break
@@ -1,5 +1,10 @@
+import importlib
+
 from cayleypy import CayleyGraph, load_dataset, bfs_numpy, PermutationGroups
 
+# Module has the same name as the function exported by the package.
+bfs_numpy_module = importlib.import_module("cayleypy.bfs_numpy")
+
 
 def test_bfs_numpy():
     graph = CayleyGraph(PermutationGroups.lrx(7))
@@ -14,3 +19,17 @@ def test_bfs_numpy():
     central_state = "000000000111111111"
     graph = CayleyGraph(PermutationGroups.top_spin(18).with_central_state(central_state))
     assert bfs_numpy(graph) == load_dataset("top_spin_coset_growth")[central_state]
+
+
+def test_bfs_numpy_compiled_permutations(monkeypatch):
+    compiled_permutations = {}
+    monkeypatch.setattr(bfs_numpy_module, "_compiled_permutations", compiled_permutations)
+    monkeypatch.setattr(bfs_numpy_module, "_NUMBA_MIN_LAYER_SIZE", 100)
+    graph = CayleyGraph(PermutationGroups.lrx(8))
+    assert bfs_numpy(graph) == load_dataset("lrx_cayley_growth")["8"]
+    assert len(compiled_permutations) == len(graph.generators)
+
+    # Second run uses compiled permutations from the start, without compiling them again.
+    perm_funcs = list(compiled_permutations.values())
+    assert bfs_numpy(graph) == load_dataset("lrx_cayley_growth")["8"]
+    assert list(compiled_permutations.values()) == perm_funcs
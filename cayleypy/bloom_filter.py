@@ -0,0 +1,62 @@
+import numba
+import numpy as np
+import torch
+
+from .torch_utils import isin_via_searchsorted
+
+_NUM_HASHES = 3
+_MULTIPLIER = 0x9E3779B97F4A7C15
+
+
+# Kernels are compiled on first use rather than at import, because most users never need them.
+@numba.njit
+def _build_filter(elements, log_bits):
+    bits = np.zeros((1 << (log_bits - 6),), dtype=np.uint64)
+    shift = np.uint64(64 - log_bits)
+    for i in range(len(elements)):
+        h = np.uint64(elements[i]) * np.uint64(_MULTIPLIER)
+        for _ in range(_NUM_HASHES):
+            pos = h >> shift
+            bits[pos >> np.uint64(6)] |= np.uint64(1) << (pos & np.uint64(63))
+            h = (h << np.uint64(21)) | (h >> np.uint64(43))
+    return bits
+
+
+@numba.njit
+def _might_contain(bits, log_bits, elements):
+    ans = np.empty((len(elements),), dtype=np.bool_)
+    shift = np.uint64(64 - log_bits)
+    for i in range(len(elements)):
+        h = np.uint64(elements[i]) * np.uint64(_MULTIPLIER)
+        found = True
+        for _ in range(_NUM_HASHES):
+            pos = h >> shift
+            if ((bits[pos >> np.uint64(6)] >> (pos & np.uint64(63))) & np.uint64(1)) == 0:
+                found = False
+                break
+            h = (h << np.uint64(21)) | (h >> np.uint64(43))
+        ans[i] = found
+    return ans
+
+
+class BloomFilteredSortedSet:
+    """Sorted set of int64 values (e.g. state hashes) with a Bloom filter in front of exact lookup.
+
+    Membership checks first test elements against the Bloom filter, and binary search is done only for elements that
+    passed it. This is faster than `isin_via_searchsorted` when most of the tested elements are not in the set.
+    Works only on CPU.
+    """
+
+    def __init__(self, elements_sorted: torch.Tensor, bits_per_element: int = 8):
+        assert elements_sorted.device.type == "cpu"
+        self.elements_sorted = elements_sorted
+        self.log_bits = max(6, (len(elements_sorted) * bits_per_element - 1).bit_length())
+        self.bits = _build_filter(np.ascontiguousarray(elements_sorted.numpy()), self.log_bits)
+
+    def isin(self, elements: torch.Tensor) -> torch.Tensor:
+        """Equivalent to torch.isin(elements, self.elements_sorted)."""
+        maybe = torch.from_numpy(_might_contain(self.bits, self.log_bits, np.ascontiguousarray(elements.numpy())))
+        idx = torch.nonzero(maybe).reshape(-1)
+        ans = torch.zeros_like(maybe)
+        ans[idx] = isin_via_searchsorted(elements[idx], self.elements_sorted)
+        return ans
@@ -0,0 +1,14 @@
+import pytest
+import torch
+
+from .bloom_filter import BloomFilteredSortedSet
+
+
+@pytest.mark.parametrize("set_size,num_elements", [(0, 10), (1, 10), (1000, 100), (10**5, 10**5)])
+def test_isin(set_size: int, num_elements: int):
+    test_elements = torch.unique(torch.randint(-(2**62), 2**62, (set_size,), dtype=torch.int64))
+    other_elements = torch.randint(-(2**62), 2**62, (num_elements,), dtype=torch.int64)
+    elements = torch.hstack([other_elements, test_elements[: num_elements // 2]])
+    elements = elements[torch.randperm(len(elements))]
+    result = BloomFilteredSortedSet(test_elements).isin(elements)
+    assert torch.equal(result, torch.isin(elements, test_elements))
@@ -1,17 +1,18 @@
 import gc
 import math
 from dataclasses import dataclass
-from functools import cached_property
+from functools import cached_property, partial
 from typing import Callable, Optional, Union
 
 import numpy as np
 import torch
 
 from .bfs_result import BfsResult
+from .bloom_filter import BloomFilteredSortedSet
 from .hasher import StateHasher
 from .permutation_utils import inverse_permutation
 from .string_encoder import StringEncoder
-from .torch_utils import isin_via_searchsorted
+from .torch_utils import isin_via_searchsorted, smallest_int_dtype
 
 
 @dataclass(frozen=True)
@@ -115,6 +116,8 @@ class CayleyGraph:
         batch_size: int = 2**20,
         hash_chunk_size: int = 2**25,
         memory_limit_gb: float = 16,
+        use_torch_compile: bool = False,
+        max_frontier_bytes: int = 2**28,
     ):
         """Initializes CayleyGraph.
 
@@ -123,18 +126,25 @@ class CayleyGraph:
         :param random_seed: random seed for deterministic hashing.
         :param bit_encoding_width: how many bits (between 1 and 63) to use to encode one element in a state.
                  If 'auto', optimal width will be picked.
-                 If None, elements will be encoded by int64 numbers.
+                 If None, elements will be stored as numbers of the smallest integer type that fits 0..n-1.
         :param verbose: Level of logging. 0 means no logging.
         :param batch_size: Size of batch for batch processing.
         :param hash_chunk_size: Size of chunk for hashing.
         :param memory_limit_gb: Approximate available memory, in GB.
                  It is safe to set this to less than available on your machine, it will just cause more frequent calls
                  to the "free memory" function.
+        :param use_torch_compile: whether to compile computation of neighbors and their hashes with `torch.compile`.
+                 This makes every BFS step faster, but compilation on first call may take up to few minutes, and
+                 requires a working C++ compiler when running on CPU.
+        :param max_frontier_bytes: maximal size of buffer for neighbors of BFS layer, which is reused between layers.
+                 Neighbors of larger layers are stored in newly allocated tensors.
         """
         self.definition = definition
         self.verbose = verbose
         self.batch_size = batch_size
         self.memory_limit_bytes = int(memory_limit_gb * (2**30))
+        self.max_frontier_bytes = max_frontier_bytes
+        self.use_torch_compile = use_torch_compile
 
         # Pick device. It will be used to store all tensors.
         assert device in ["auto", "cpu", "cuda"]
@@ -156,29 +166,46 @@ class CayleyGraph:
         if bit_encoding_width is not None:
             self.string_encoder = StringEncoder(code_width=int(bit_encoding_width), n=self.definition.state_size)
             self.encoded_generators = [
-                self.string_encoder.implement_permutation(perm) for perm in definition.generators
+                self.string_encoder.implement_permutation(perm, word_major=True) for perm in definition.generators
             ]
             encoded_state_size = self.string_encoder.encoded_length
 
+        # Type of elements of states in internal representation. Encoded states are always int64.
+        self.state_dtype = torch.int64
+        if self.string_encoder is None:
+            self.state_dtype = smallest_int_dtype(self.definition.state_size - 1)
+
         self.hasher = StateHasher(encoded_state_size, random_seed, self.device, chunk_size=hash_chunk_size)
 
+        self._get_neighbors_and_hashes: Callable[[torch.Tensor], tuple[torch.Tensor, torch.Tensor]]
+        self._neighbors_buffer = torch.empty((0,), dtype=self.state_dtype, device=self.device)
+        self._get_neighbors_and_hashes = partial(self._get_neighbors_and_hashes_eager, reuse_buffer=True)
+        if use_torch_compile:
+            # Shapes change from layer to layer, so we ask to compile with dynamic shapes once, instead of recompiling.
+            self._get_neighbors_and_hashes = torch.compile(self._get_neighbors_and_hashes_eager, dynamic=True)
+
     def get_unique_states(
         self, states: torch.Tensor, hashes: Optional[torch.Tensor] = None
     ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         """Removes duplicates from `states`. May change order."""
         if hashes is None:
             hashes = self.hasher.make_hashes(states)
+        unique_idx = self._get_unique_idx(hashes)
+        unique_states = states[unique_idx]
+        unique_hashes = self.hasher.make_hashes(unique_states) if self.hasher.is_identity else hashes[unique_idx]
+        return unique_states, unique_hashes, unique_idx
+
+    def _get_unique_idx(self, hashes: torch.Tensor) -> torch.Tensor:
+        # Returns indices of first occurrences of unique hashes, in order of increasing hash.
+        # We deduplicate states by their hashes, so this needs only one sort of int64 numbers, which is faster than
+        # sorting the states themselves (as e.g. np.unique(states, axis=0) does).
         hashes_sorted, idx = torch.sort(hashes, stable=True)
 
         # Compute mask of first occurrences for each unique value.
         mask = torch.ones(hashes_sorted.size(0), dtype=torch.bool, device=self.device)
         if hashes_sorted.size(0) > 1:
             mask[1:] = hashes_sorted[1:] != hashes_sorted[:-1]
-
-        unique_idx = idx[mask]
-        unique_states = states[unique_idx]
-        unique_hashes = self.hasher.make_hashes(unique_states) if self.hasher.is_identity else hashes[unique_idx]
-        return unique_states, unique_hashes, unique_idx
+        return idx[mask]
 
     def encode_states(self, states: Union[torch.Tensor, np.ndarray, list]) -> torch.Tensor:
         """Converts states from human-readable to internal representation."""
@@ -189,31 +216,86 @@ class CayleyGraph:
         assert states.shape[1] == self.definition.state_size
         if self.string_encoder is not None:
             return self.string_encoder.encode(states)
-        return states
+        max_value = torch.iinfo(self.state_dtype).max
+        if states.numel() > 0 and (int(states.min()) < 0 or int(states.max()) > max_value):
+            raise ValueError(f"State elements must be between 0 and {max_value}.")
+        return states.to(self.state_dtype)
 
     def decode_states(self, states: torch.Tensor) -> torch.Tensor:
         """Converts states from internal to human-readable representation."""
         if self.string_encoder is not None:
             return self.string_encoder.decode(states)
-        return states
+        return states.to(torch.int64)
 
     def get_neighbors(self, states: torch.Tensor) -> torch.Tensor:
-        """Calculates all neighbors of `states` (in internal representation)."""
+        """Calculates all neighbors of `states` (in internal representation).
+
+        Neighbors are ordered by generator in the outer loop and by state in the inner loop, i.e. neighbor of
+        `states[j]` by `i`-th generator is at index `i * len(states) + j`.
+        Result is a contiguous tensor of shape `(n_generators * len(states), states.shape[1])`.
+        """
+        # For encoded states, BFS works with transposed view returned by _get_neighbors, without copying it.
+        return self._get_neighbors(states, reuse_buffer=False).contiguous()
+
+    def _alloc_neighbors(self, numel: int, reuse_buffer: bool) -> torch.Tensor:
+        # Neighbors are computed on every BFS step, so instead of allocating memory for them every time, we keep one
+        # buffer and grow it when needed (unless it gets too big).
+        # The buffer is overwritten on the next call, so callers must never keep a view of it beyond the current BFS
+        # step: anything that outlives the step (layers, hashes, edges) has to be copied out of it.
+        item_size = self._neighbors_buffer.element_size()
+        if not reuse_buffer or numel * item_size > self.max_frontier_bytes:
+            return torch.empty((numel,), dtype=self.state_dtype, device=self.device)
+        if self._neighbors_buffer.numel() < numel:
+            buffer_size = min(max(numel, 2 * self._neighbors_buffer.numel()), self.max_frontier_bytes // item_size)
+            # Free old buffer before allocating new one.
+            self._neighbors_buffer = torch.empty((0,), dtype=self.state_dtype, device=self.device)
+            self._neighbors_buffer = torch.empty((buffer_size,), dtype=self.state_dtype, device=self.device)
+        return self._neighbors_buffer[:numel]
+
+    def _get_neighbors(self, states: torch.Tensor, reuse_buffer: bool) -> torch.Tensor:
         states_num = states.shape[0]
-        neighbors = torch.zeros(
-            (states_num * self.definition.n_generators, states.shape[1]), dtype=torch.int64, device=self.device
-        )
+        neighbors_num = states_num * self.definition.n_generators
         if self.string_encoder is not None:
+            # Bit operations are done in word-major layout, so that each code word is a contiguous vector.
+            states_t = states.T.contiguous()
+            neighbors = self._alloc_neighbors(neighbors_num * states.shape[1], reuse_buffer)
+            neighbors_t = neighbors.view(states.shape[1], neighbors_num).zero_()
             for i in range(self.definition.n_generators):
-                self.encoded_generators[i](states, neighbors[i * states_num : (i + 1) * states_num])
+                self.encoded_generators[i](states_t, neighbors_t[:, i * states_num : (i + 1) * states_num])
+            return neighbors_t.T
         else:
+            # Apply all generators to all states with a single gather, without intermediate copies.
             moves = self.generators_torch
-            neighbors[:, :] = torch.gather(
-                states.unsqueeze(1).expand(states.size(0), moves.shape[0], states.size(1)),
-                2,
-                moves.unsqueeze(0).expand(states.size(0), moves.shape[0], states.size(1)),
-            ).flatten(end_dim=1)
-        return neighbors
+            shape = (moves.shape[0], states_num, states.shape[1])
+            if not reuse_buffer:
+                # This is also the path compiled with torch.compile, which can't trace gather with `out` argument.
+                neighbors = torch.gather(states.unsqueeze(0).expand(shape), 2, moves.unsqueeze(1).expand(shape))
+                return neighbors.flatten(end_dim=1)
+            neighbors = self._alloc_neighbors(neighbors_num * states.shape[1], reuse_buffer).view(shape)
+            torch.gather(states.unsqueeze(0).expand(shape), 2, moves.unsqueeze(1).expand(shape), out=neighbors)
+            return neighbors.flatten(end_dim=1)
+
+    def _get_neighbors_and_hashes_eager(
+        self, states: torch.Tensor, reuse_buffer: bool = False
+    ) -> tuple[torch.Tensor, torch.Tensor]:
+        neighbors = self._get_neighbors(states, reuse_buffer)
+        return neighbors, self.hasher.make_hashes(neighbors)
+
+    def _get_neighbors_by_idx(self, states: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+        # Computes only neighbors with given indices (in the order returned by get_neighbors).
+        generator_idx, state_idx = idx // states.shape[0], idx % states.shape[0]
+        ans = torch.empty((len(idx), states.shape[1]), dtype=states.dtype, device=self.device)
+        for i in range(self.definition.n_generators):
+            pos = torch.nonzero(generator_idx == i).reshape(-1)
+            ans[pos] = states[state_idx[pos].unsqueeze(1), self.generators_torch[i].unsqueeze(0)]
+        return ans
+
+    def _make_isin_func(self, hashes_sorted: torch.Tensor) -> Callable[[torch.Tensor], torch.Tensor]:
+        # Almost all neighbors of a layer are not in that layer itself, so on CPU it's faster to reject them with a
+        # Bloom filter first than to binary search for every one of them.
+        if self.device.type == "cpu":
+            return BloomFilteredSortedSet(hashes_sorted).isin
+        return lambda x: isin_via_searchsorted(x, hashes_sorted)
 
     def bfs(
         self,
@@ -270,16 +352,22 @@ class CayleyGraph:
         do_batching = (
             self.string_encoder is not None and self.string_encoder.encoded_length == 1 and not return_all_edges
         )
+        # When states are not encoded, we can compute hashes of neighbors directly from the states (because hash
+        # function is linear), and then compute only the neighbors that are new states.
+        hash_before_neighbors = (
+            self.string_encoder is None and not self.hasher.is_identity and not self.use_torch_compile
+        )
 
         # BFS iteration: layer2 := neighbors(layer1)-layer0-layer1.
         for i in range(1, max_diameter + 1):
+            isin_layer1 = self._make_isin_func(layer1_hashes)
             if do_batching and len(layer1) > self.batch_size:
                 num_batches = int(math.ceil(layer1_hashes.shape[0] / self.batch_size))
                 layer2_batches = []  # type: list[torch.Tensor]
                 for layer1_batch in layer1.tensor_split(num_batches, dim=0):
-                    layer2_batch = self.get_neighbors(layer1_batch).reshape((-1,))
+                    _, layer2_batch = self._get_neighbors_and_hashes(layer1_batch)
                     layer2_batch = torch.unique(layer2_batch, sorted=True)
-                    mask = ~isin_via_searchsorted(layer2_batch, layer1_hashes)
+                    mask = ~isin_layer1(layer2_batch)
                     if i > 1:
                         mask &= ~isin_via_searchsorted(layer2_batch, layer0_hashes)
                     for other_batch in layer2_batches:
@@ -294,20 +382,29 @@ class CayleyGraph:
                     layer2_hashes, _ = torch.sort(layer2_hashes)
                 layer2 = layer2_hashes.reshape((-1, 1))
             else:
-                layer1_neighbors = self.get_neighbors(layer1)
-                layer1_neighbors_hashes = self.hasher.make_hashes(layer1_neighbors)
+                if hash_before_neighbors:
+                    layer1_neighbors_hashes = self.hasher.make_hashes_of_permuted(layer1, self.definition.generators)
+                else:
+                    layer1_neighbors, layer1_neighbors_hashes = self._get_neighbors_and_hashes(layer1)
                 if return_all_edges:
-                    if self.string_encoder is not None:
-                        edges_list_starts += [layer1_hashes] * self.definition.n_generators
-                    else:
-                        edges_list_starts.append(layer1_hashes.repeat_interleave(self.definition.n_generators))
+                    edges_list_starts += [layer1_hashes] * self.definition.n_generators
+                    if self.hasher.is_identity:
+                        # Identity hashes are a view of neighbors buffer, which is overwritten on the next step.
+                        layer1_neighbors_hashes = layer1_neighbors_hashes.clone()
                     edges_list_ends.append(layer1_neighbors_hashes)
 
-                layer2, layer2_hashes, _ = self.get_unique_states(layer1_neighbors, hashes=layer1_neighbors_hashes)
-                mask = ~isin_via_searchsorted(layer2_hashes, layer1_hashes)
+                if hash_before_neighbors:
+                    layer2_idx = self._get_unique_idx(layer1_neighbors_hashes)
+                    layer2_hashes = layer1_neighbors_hashes[layer2_idx]
+                else:
+                    layer2, layer2_hashes, _ = self.get_unique_states(layer1_neighbors, hashes=layer1_neighbors_hashes)
+                mask = ~isin_layer1(layer2_hashes)
                 if i > 1:
                     mask &= ~isin_via_searchsorted(layer2_hashes, layer0_hashes)
-                layer2 = layer2[mask]
+                if hash_before_neighbors:
+                    layer2 = self._get_neighbors_by_idx(layer1, layer2_idx[mask])
+                else:
+                    layer2 = layer2[mask]
                 layer2_hashes = self.hasher.make_hashes(layer2) if self.hasher.is_identity else layer2_hashes[mask]
 
             if layer2.shape[0] * layer2.shape[1] * 8 > 0.1 * self.memory_limit_bytes:
@@ -361,6 +458,7 @@ class CayleyGraph:
     def free_memory(self):
         if self.verbose >= 1:
             print("Freeing memory...")
+        self._neighbors_buffer = torch.empty((0,), dtype=self.state_dtype, device=self.device)
         gc.collect()
         if self.device.type == "cuda":
             torch.cuda.empty_cache()
@@ -1,3 +1,4 @@
+import hashlib
 import os
 
 import numpy as np
@@ -10,17 +11,38 @@ from cayleypy.graphs_lib import PermutationGroups
 
 FAST_RUN = os.getenv("FAST") == "1"
 BENCHMARK_RUN = os.getenv("BENCHMARK") == "1"
+TORCH_COMPILE_RUN = os.getenv("TORCH_COMPILE") == "1"
+
+_CONST_GENERATORS_3 = [[1, 2, 0], [2, 0, 1], [1, 0, 2]]
+_CONST_GENERATORS_3_TENSOR = torch.tensor(_CONST_GENERATORS_3)
+_CONST_NEIGHBORS_STATES = torch.tensor([[10, 11, 12, 13, 14], [15, 16, 17, 18, 19]], dtype=torch.int64)
+_CONST_NEIGHBORS_EXPECTED = torch.tensor(
+    [[11, 10, 12, 13, 14], [16, 15, 17, 18, 19], [10, 11, 12, 14, 13], [15, 16, 17, 19, 18]]
+)
 
 
 def _layer_to_set(layer: np.ndarray) -> set[str]:
-    return set("".join(str(x) for x in state) for state in layer)
+    # Maps digits to ASCII codes and views each row as a byte string. Assumes all elements are between 0 and 9.
+    codes = np.ascontiguousarray(layer + ord("0"), dtype=np.uint8)
+    return set(codes.view(f"S{layer.shape[1]}").ravel().astype(str).tolist())
+
+
+def _eq(a: torch.Tensor, b: torch.Tensor) -> bool:
+    # Compares tensors on device of `a`, so results computed on GPU are not copied to CPU.
+    return torch.equal(a, b.to(a.device))
+
+
+def _layer_digest(layer: np.ndarray) -> str:
+    # Digest of layer that doesn't depend on order of states. Used to check large layers without listing all states.
+    layer = np.asarray(layer, dtype=np.int64)
+    rows = np.ascontiguousarray(layer[np.lexsort(layer.T[::-1])])
+    return hashlib.blake2b(rows.tobytes(), digest_size=16, usedforsecurity=False).hexdigest()
 
 
 def test_generators_format():
-    generators = [[1, 2, 0], [2, 0, 1], [1, 0, 2]]
-    graph1 = CayleyGraphDef.create(generators)
-    graph2 = CayleyGraphDef.create(np.array(generators))
-    graph3 = CayleyGraphDef.create(torch.tensor(generators))
+    graph1 = CayleyGraphDef.create(_CONST_GENERATORS_3)
+    graph2 = CayleyGraphDef.create(np.array(_CONST_GENERATORS_3))
+    graph3 = CayleyGraphDef.create(_CONST_GENERATORS_3_TENSOR)
     assert np.array_equal(graph1.generators, graph2.generators)
     assert np.array_equal(graph1.generators, graph3.generators)
 
@@ -54,44 +76,44 @@ def test_bfs_lrx_coset_5():
     assert ans.layer_sizes == [1, 3, 5, 8, 7, 5, 1]
     assert _layer_to_set(ans.get_layer(0)) == {"01210"}
     assert _layer_to_set(ans.get_layer(1)) == {"00121", "10210", "12100"}
+    assert _layer_digest(ans.get_layer(3)) == "64f9d10a95ee1b2ad3e995531966de7d"
+    assert _layer_digest(ans.get_layer(4)) == "e731e625a19299ff19a79a0580d1bccf"
     assert _layer_to_set(ans.get_layer(5)) == {"00112", "01120", "01201", "02011", "11020"}
     assert _layer_to_set(ans.get_layer(6)) == {"10201"}
 
 
-def test_bfs_lrx_coset_10():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    ans = graph.bfs()
+def test_bfs_lrx_coset_10(lrx10_coset_graph):
+    ans = lrx10_coset_graph.bfs()
     assert ans.diameter() == 17
     assert ans.layer_sizes == [1, 3, 4, 6, 11, 16, 19, 23, 31, 29, 20, 14, 10, 10, 6, 3, 3, 1]
     assert _layer_to_set(ans.get_layer(0)) == {"0110110110"}
     assert _layer_to_set(ans.get_layer(1)) == {"0011011011", "1010110110", "1101101100"}
+    assert _layer_digest(ans.get_layer(8)) == "a5b2a4b852c8a4d094eccef276ff8239"
+    assert _layer_digest(ans.get_layer(9)) == "a13905ceffe4b95793a57698417f0699"
     assert _layer_to_set(ans.get_layer(15)) == {"0001111110", "0111111000", "1110000111"}
     assert _layer_to_set(ans.get_layer(16)) == {"0011111100", "1111000011", "1111110000"}
     assert _layer_to_set(ans.get_layer(17)) == {"1111100001"}
 
 
-def test_bfs_max_radius():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    ans = graph.bfs(max_diameter=5)
+def test_bfs_max_radius(lrx10_coset_graph):
+    ans = lrx10_coset_graph.bfs(max_diameter=5)
     assert not ans.bfs_completed
     assert ans.layer_sizes == [1, 3, 4, 6, 11, 16]
 
 
-def test_bfs_max_layer_size_to_explore():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    ans = graph.bfs(max_layer_size_to_explore=10)
+def test_bfs_max_layer_size_to_explore(lrx10_coset_graph):
+    ans = lrx10_coset_graph.bfs(max_layer_size_to_explore=10)
     assert not ans.bfs_completed
     assert ans.layer_sizes == [1, 3, 4, 6, 11]
 
 
-def test_bfs_max_layer_size_to_store():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    ans = graph.bfs(max_layer_size_to_store=10)
+def test_bfs_max_layer_size_to_store(lrx10_coset_graph):
+    ans = lrx10_coset_graph.bfs(max_layer_size_to_store=10)
     assert ans.bfs_completed
     assert ans.diameter() == 17
     assert ans.layers.keys() == {0, 1, 2, 3, 12, 13, 14, 15, 16, 17}
 
-    ans = graph.bfs(max_layer_size_to_store=None)
+    ans = lrx10_coset_graph.bfs(max_layer_size_to_store=None)
     assert ans.bfs_completed
     assert ans.diameter() == 17
     assert ans.layers.keys() == set(range(18))
@@ -129,11 +151,49 @@ def test_bfs_last_layer_lrx_coset_n8():
     assert _layer_to_set(graph.bfs().last_layer()) == {"11003322", "22110033", "33221100", "00332211"}
 
 
+def test_bfs_bit_encoding_correctness(lrx8_bfs_result):
+    assert lrx8_bfs_result.layer_sizes == load_dataset("lrx_cayley_growth")["8"]
+
+
 @pytest.mark.parametrize("bit_encoding_width", [None, 3, 10, "auto"])
-def test_bfs_bit_encoding(bit_encoding_width):
+def test_bfs_bit_encoding_encoder(bit_encoding_width, lrx8_bfs_result):
+    # Instead of running full BFS for each encoding, check encoding and neighbors on a sample of states.
     graph_def = PermutationGroups.lrx(8)
-    result = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width).bfs()
-    assert result.layer_sizes == load_dataset("lrx_cayley_growth")["8"]
+    graph = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width)
+    states = lrx8_bfs_result.all_states[::97].to(graph.device)
+    encoded = graph.encode_states(states)
+    assert torch.equal(graph.decode_states(encoded), states)
+    expected_neighbors = torch.vstack([states[:, gen] for gen in graph_def.generators])
+    assert torch.equal(graph.decode_states(graph.get_neighbors(encoded)), expected_neighbors)
+
+
+@pytest.mark.parametrize("n,state_dtype", [(4, torch.uint8), (256, torch.uint8), (257, torch.int16)])
+def test_state_dtype(n: int, state_dtype: torch.dtype):
+    graph = CayleyGraph(PermutationGroups.lrx(n), bit_encoding_width=None)
+    assert graph.state_dtype == state_dtype
+    encoded = graph.encode_states(graph.central_state)
+    assert encoded.dtype == state_dtype
+    decoded = graph.decode_states(graph.get_neighbors(encoded))
+    assert decoded.dtype == torch.int64
+    assert torch.equal(decoded, torch.vstack([graph.central_state[gen] for gen in graph.generators_torch]))
+
+
+def test_get_neighbors_by_idx():
+    graph = CayleyGraph(PermutationGroups.lrx(20), bit_encoding_width=None)
+    states = graph.encode_states(torch.vstack([torch.randperm(20) for _ in range(30)]))
+    idx = torch.randperm(30 * graph.definition.n_generators)[:50]
+    neighbors = graph._get_neighbors_by_idx(states, idx)  # pylint: disable=protected-access
+    assert torch.equal(neighbors, graph.get_neighbors(states)[idx])
+
+def test_state_dtype_fits_start_states():
+    # Central state has only 0s and 1s, but start states may have any elements from 0 to n-1.
+    graph = CayleyGraph(PermutationGroups.lrx(300).with_central_state([0] * 150 + [1] * 150), bit_encoding_width=None)
+    assert graph.state_dtype == torch.int16
+    start_state = list(range(300))
+    result = graph.bfs(start_states=[start_state], max_diameter=1)
+    assert list(result.get_layer(0)[0]) == start_state
+    with pytest.raises(ValueError):
+        graph.encode_states([2**15] * 300)
 
 
 @pytest.mark.parametrize("batch_size", [100, 1000, 10**9])
@@ -151,34 +211,48 @@ def test_bfs_batching_all_transpositions():
     assert result.layer_sizes == load_dataset("all_transpositions_cayley_growth")["8"]
 
 
+@pytest.mark.parametrize("bit_encoding_width", [None, "auto"])
 @pytest.mark.parametrize("hash_chunk_size", [100, 1000, 10**9])
-def test_bfs_hash_chunking(hash_chunk_size: int):
+def test_bfs_hash_chunking(bit_encoding_width, hash_chunk_size: int):
     graph_def = PermutationGroups.lrx(8)
-    result = CayleyGraph(graph_def, hash_chunk_size=hash_chunk_size).bfs()
+    result = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width, hash_chunk_size=hash_chunk_size).bfs()
     assert result.layer_sizes == load_dataset("lrx_cayley_growth")["8"]
 
 
+@pytest.mark.parametrize("max_frontier_bytes", [0, 1000, 2**28])
+def test_bfs_neighbors_buffer(max_frontier_bytes: int):
+    graph = CayleyGraph(PermutationGroups.lrx(8), max_frontier_bytes=max_frontier_bytes)
+    expected = CayleyGraph(PermutationGroups.lrx(8), max_frontier_bytes=0).bfs(return_all_edges=True)
+    for _ in range(2):
+        result = graph.bfs(return_all_edges=True)
+        assert result.layer_sizes == load_dataset("lrx_cayley_growth")["8"]
+        assert result.edges_list_hashes is not None and expected.edges_list_hashes is not None
+        assert torch.equal(result.edges_list_hashes, expected.edges_list_hashes)
+
+
+# Compilation needs a C++ compiler and takes long, so this test is opt-in. To run: `TORCH_COMPILE=1 pytest . -k compile`
+@pytest.mark.skipif(not TORCH_COMPILE_RUN, reason="requires torch.compile toolchain")
+@pytest.mark.parametrize("bit_encoding_width", [None, "auto"])
+@pytest.mark.parametrize("batch_size", [100, 10**9])
+def test_bfs_torch_compile(bit_encoding_width, batch_size: int):
+    graph_def = PermutationGroups.lrx(8)
+    graph = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width, batch_size=batch_size, use_torch_compile=True)
+    assert graph.bfs().layer_sizes == load_dataset("lrx_cayley_growth")["8"]
+
+
 @pytest.mark.parametrize("bit_encoding_width", [None, 5])
 def test_get_neighbors(bit_encoding_width):
-    # Directly check _get_neighbors_batched.
+    # Directly check get_neighbors.
     # In what order it generates neighbours is an implementation detail. However, we rely on this convention when
     # generating the edges list.
     graph_def = CayleyGraphDef.create([[1, 0, 2, 3, 4], [0, 1, 2, 4, 3]])
     graph = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width)
-    states = graph.encode_states(torch.tensor([[10, 11, 12, 13, 14], [15, 16, 17, 18, 19]], dtype=torch.int64))
-    result = graph.decode_states(graph.get_neighbors(states))
-    if bit_encoding_width == 5:
-        # When using StringEncoder, we go over the generators in outer loop, and over the states in inner loop.
-        assert torch.equal(
-            result.cpu(),
-            torch.tensor([[11, 10, 12, 13, 14], [16, 15, 17, 18, 19], [10, 11, 12, 14, 13], [15, 16, 17, 19, 18]]),
-        )
-    else:
-        # When operating on ints directly, it's the other way around.
-        assert torch.equal(
-            result.cpu(),
-            torch.tensor([[11, 10, 12, 13, 14], [10, 11, 12, 14, 13], [16, 15, 17, 18, 19], [15, 16, 17, 19, 18]]),
-        )
+    states = graph.encode_states(_CONST_NEIGHBORS_STATES)
+    neighbors = graph.get_neighbors(states)
+    assert neighbors.is_contiguous()
+    result = graph.decode_states(neighbors)
+    # We go over the generators in outer loop, and over the states in inner loop.
+    assert _eq(result, _CONST_NEIGHBORS_EXPECTED)
 
 
 def test_edges_list_n2():
@@ -187,14 +261,16 @@ def test_edges_list_n2():
     assert result.named_undirected_edges() == {("01", "10")}
 
 
-def test_edges_list_n3():
-    graph = CayleyGraph(PermutationGroups.lrx(3).with_central_state("001"))
+@pytest.mark.parametrize("bit_encoding_width", [None, "auto"])
+def test_edges_list_n3(bit_encoding_width):
+    graph = CayleyGraph(PermutationGroups.lrx(3).with_central_state("001"), bit_encoding_width=bit_encoding_width)
     result = graph.bfs(return_all_edges=True, return_all_hashes=True)
     assert result.named_undirected_edges() == {("001", "001"), ("001", "010"), ("001", "100"), ("010", "100")}
 
 
-def test_edges_list_n4():
-    graph = CayleyGraph(PermutationGroups.top_spin(4).with_central_state("0011"))
+@pytest.mark.parametrize("bit_encoding_width", [None, "auto"])
+def test_edges_list_n4(bit_encoding_width):
+    graph = CayleyGraph(PermutationGroups.top_spin(4).with_central_state("0011"), bit_encoding_width=bit_encoding_width)
     result = graph.bfs(return_all_edges=True, return_all_hashes=True)
     assert result.named_undirected_edges() == {
         ("0011", "0110"),
@@ -215,31 +291,29 @@ def test_generators_not_inverse_closed():
 
 
 # Tests below compare growth function for small graphs with stored pre-computed results.
-def test_lrx_cayley_growth():
-    expected = load_dataset("lrx_cayley_growth")
-    for n in range(3, 10):
-        graph = CayleyGraph(PermutationGroups.lrx(n))
-        result = graph.bfs()
-        assert result.layer_sizes == expected[str(n)]
+@pytest.mark.parametrize("n", range(3, 10))
+def test_lrx_cayley_growth(n: int):
+    graph = CayleyGraph(PermutationGroups.lrx(n))
+    assert graph.bfs().layer_sizes == load_dataset("lrx_cayley_growth")[str(n)]
 
 
-def test_top_spin_cayley_growth():
-    expected = load_dataset("top_spin_cayley_growth")
-    for n in range(4, 10):
-        graph = CayleyGraph(PermutationGroups.top_spin(n))
-        result = graph.bfs()
-        assert result.layer_sizes == expected[str(n)]
+@pytest.mark.parametrize("n", range(4, 10))
+def test_top_spin_cayley_growth(n: int):
+    graph = CayleyGraph(PermutationGroups.top_spin(n))
+    assert graph.bfs().layer_sizes == load_dataset("top_spin_cayley_growth")[str(n)]
 
 
-def test_lrx_coset_growth():
-    expected = load_dataset("lrx_coset_growth")
-    for central_state, expected_layer_sizes in expected.items():
-        if len(central_state) > 15:
-            continue
-        generators = PermutationGroups.lrx(len(central_state)).generators
-        graph = CayleyGraph(CayleyGraphDef.create(generators, central_state=central_state))
-        result = graph.bfs()
-        assert result.layer_sizes == expected_layer_sizes
+@pytest.mark.parametrize(
+    "central_state",
+    [
+        pytest.param(s, marks=pytest.mark.skip(reason="slow test")) if len(s) > 15 else s
+        for s in load_dataset("lrx_coset_growth")
+    ],
+)
+def test_lrx_coset_growth(central_state: str):
+    generators = PermutationGroups.lrx(len(central_state)).generators
+    graph = CayleyGraph(CayleyGraphDef.create(generators, central_state=central_state))
+    assert graph.bfs().layer_sizes == load_dataset("lrx_coset_growth")[central_state]
 
 
 # To skip slower tests ike this, do `FAST=1 pytest`
@@ -281,25 +355,22 @@ def test_bfs_small_hash_chunk_size():
     assert graph.bfs(max_diameter=8).layer_sizes == [1, 3, 6, 12, 24, 48, 91, 172, 325]
 
 
-def test_hashes_list_len():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    result = graph.bfs(return_all_edges=True, return_all_hashes=True)
+def test_hashes_list_len(lrx10_coset_graph):
+    result = lrx10_coset_graph.bfs(return_all_edges=True, return_all_hashes=True)
     assert result.bfs_completed
     assert result.num_vertices == len(result.vertices_hashes)
     assert result.num_vertices == len(result.vertex_names)
 
 
-def test_hashes_list_len_max_radius():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    result = graph.bfs(return_all_edges=True, return_all_hashes=True, max_diameter=2)
+def test_hashes_list_len_max_radius(lrx10_coset_graph):
+    result = lrx10_coset_graph.bfs(return_all_edges=True, return_all_hashes=True, max_diameter=2)
     assert not result.bfs_completed
     assert result.num_vertices == len(result.vertices_hashes)
     assert result.num_vertices == len(result.vertex_names)
 
 
-def test_hashes_list_len_max_layer_size_to_explore():
-    graph = CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
-    result = graph.bfs(return_all_edges=True, return_all_hashes=True, max_layer_size_to_explore=2)
+def test_hashes_list_len_max_layer_size_to_explore(lrx10_coset_graph):
+    result = lrx10_coset_graph.bfs(return_all_edges=True, return_all_hashes=True, max_layer_size_to_explore=2)
     assert not result.bfs_completed
     assert result.num_vertices == len(result.vertices_hashes)
     assert result.num_vertices == len(result.vertex_names)
@@ -307,15 +378,22 @@ def test_hashes_list_len_max_layer_size_to_explore():
 
 # Below is the benchmark code. To run: `BENCHMARK=1 pytest . -k benchmark`
 @pytest.mark.skipif(not BENCHMARK_RUN, reason="benchmark")
-@pytest.mark.parametrize("benchmark_mode", ["baseline", "bit_encoded", "bfs_numpy"])
+@pytest.mark.parametrize("benchmark_mode", ["baseline", "bit_encoded", "compiled", "bfs_numpy"])
 @pytest.mark.parametrize("n", [26])
-def test_benchmark_top_spin(benchmark, benchmark_mode, n):
-    central_state = [0] * (n // 2) + [1] * (n // 2)
+@pytest.mark.parametrize("device", ["cpu", "cuda"])
+def test_benchmark_top_spin(benchmark, benchmark_mode, n, device):
+    if device == "cuda" and (benchmark_mode == "bfs_numpy" or not torch.cuda.is_available()):
+        pytest.skip("CUDA is not available or not applicable.")
+    central_state = np.repeat([0, 1], n // 2)
     graph_def = PermutationGroups.lrx(n).with_central_state(central_state)
     if benchmark_mode == "bfs_numpy":
         graph = CayleyGraph(graph_def)
         benchmark.pedantic(lambda: bfs_numpy(graph), iterations=1, rounds=5)
     else:
-        bit_encoding_width = 1 if benchmark_mode == "bit_encoded" else None
-        graph = CayleyGraph(graph_def, bit_encoding_width=bit_encoding_width)
-        benchmark.pedantic(graph.bfs, iterations=1, rounds=5)
+        bit_encoding_width = None if benchmark_mode == "baseline" else 1
+        use_torch_compile = benchmark_mode == "compiled"
+        graph = CayleyGraph(
+            graph_def, device=device, bit_encoding_width=bit_encoding_width, use_torch_compile=use_torch_compile
+        )
+        # Compilation happens on the first call, so we don't measure it.
+        benchmark.pedantic(graph.bfs, iterations=1, rounds=5, warmup_rounds=1 if use_torch_compile else 0)
@@ -0,0 +1,21 @@
+import pytest
+
+from cayleypy import CayleyGraph, PermutationGroups
+from cayleypy.bfs_result import BfsResult
+
+
+@pytest.fixture(scope="session")
+def lrx10_coset_graph() -> CayleyGraph:
+    """Schreier coset graph for LRX with n=10, used by many tests.
+
+    BFS only changes the graph's internal neighbors buffer, and results never reference that buffer, so the graph can be
+    shared between tests.
+    """
+    return CayleyGraph(PermutationGroups.lrx(10).with_central_state("0110110110"))
+
+
+@pytest.fixture(scope="session")
+def lrx8_bfs_result() -> BfsResult:
+    """Result of full BFS on LRX Cayley graph with n=8, storing all layers."""
+    graph = CayleyGraph(PermutationGroups.lrx(8), bit_encoding_width=None)
+    return graph.bfs(max_layer_size_to_store=None)
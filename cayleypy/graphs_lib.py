@@ -2,6 +2,7 @@
 
 """Library of pre-defined graphs."""
 
+import functools
 from itertools import permutations
 from warnings import warn
 
@@ -119,9 +120,12 @@ class PermutationGroups:
         return CayleyGraphDef.create(generators, central_state=list(range(n)), generator_names=generator_names)
 
     @staticmethod
+    @functools.cache
     def lrx(n: int, k: int = 1) -> CayleyGraphDef:
         """Cayley graph for S_n (n>=3), generated by: shift left, shift right, swap two elements 0 and k.
 
+        Results are cached, because this graph is used very often. Returned definition must not be modified.
+
         :param n: Size of permutations.
         :param k: Specifies that X is transposition of elements 0 and k. 1<=k<n.
             By default, k=1, which means X is transposition of first 2 elements.
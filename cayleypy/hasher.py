@@ -3,6 +3,8 @@ from typing import Callable, Optional
 
 import torch
 
+from .permutation_utils import inverse_permutation
+
 
 class StateHasher:
     """Helper class to hash states by multiplying them by random vector."""
@@ -11,8 +13,8 @@ class StateHasher:
         self.state_size = state_size
         self.chunk_size = chunk_size
 
-        # If states are already encoded by a single int64, use identity function as hash function.
-        self.make_hashes: Callable[[torch.Tensor], torch.Tensor] = lambda x: x.reshape(-1)
+        # If states are already encoded by a single number, use identity function as hash function.
+        self.make_hashes: Callable[[torch.Tensor], torch.Tensor] = lambda x: x.reshape(-1).to(torch.int64)
         self.is_identity = True
         if state_size == 1:
             return
@@ -21,26 +23,44 @@ class StateHasher:
         if random_seed is not None:
             torch.manual_seed(random_seed)
         max_int = int((2**62))
-        self.vec_hasher = torch.randint(-max_int, max_int + 1, size=(state_size, 1), device=device, dtype=torch.int64)
-
-        try:
-            trial_states = torch.zeros((2, state_size), device=device, dtype=torch.int64)
-            _ = self._make_hashes_cpu_and_modern_gpu(trial_states)
-            self.make_hashes = self._make_hashes_cpu_and_modern_gpu
-        except RuntimeError:
-            self.vec_hasher = self.vec_hasher.reshape((state_size,))
-            self.make_hashes = self._make_hashes_older_gpu
+        self.vec_hasher = torch.randint(-max_int, max_int + 1, size=(state_size,), device=device, dtype=torch.int64)
+        self.vec_hasher_list = [int(x) for x in self.vec_hasher]
+        self.make_hashes = self._make_hashes
 
-    def _make_hashes_cpu_and_modern_gpu(self, states: torch.Tensor) -> torch.Tensor:
+    def _make_hashes(self, states: torch.Tensor) -> torch.Tensor:
         if states.shape[0] <= self.chunk_size:
-            return (states @ self.vec_hasher).reshape(-1)
+            return self._make_hashes_chunk(states)
         else:
             parts = int(math.ceil(states.shape[0] / self.chunk_size))
-            return torch.vstack([z @ self.vec_hasher for z in torch.tensor_split(states, parts)]).reshape(-1)
+            return torch.hstack([self._make_hashes_chunk(z) for z in torch.tensor_split(states, parts)])
 
-    def _make_hashes_older_gpu(self, states: torch.Tensor) -> torch.Tensor:
-        if states.shape[0] <= self.chunk_size:
+    def _make_hashes_chunk(self, states: torch.Tensor) -> torch.Tensor:
+        # We don't use matrix multiplication, because there are no fast kernels for it for int64 on CPU and most GPUs.
+        if states.stride(0) != 1 and states.element_size() == 8:
             return torch.sum(states * self.vec_hasher, dim=1)
-        else:
-            parts = int(math.ceil(states.shape[0] / self.chunk_size))
-            return torch.hstack([torch.sum(z * self.vec_hasher, dim=1) for z in torch.tensor_split(states, parts)])
+        # In word-major layout each column is contiguous, so we can accumulate in-place column by column. This is also
+        # faster for states stored in smaller integer types, which are cast to int64 first to avoid overflow.
+        ans = torch.mul(states[:, 0].to(torch.int64), self.vec_hasher_list[0])
+        for i in range(1, self.state_size):
+            ans.add_(states[:, i], alpha=self.vec_hasher_list[i])
+        return ans
+
+    def make_hashes_of_permuted(self, states: torch.Tensor, perms: list[list[int]]) -> torch.Tensor:
+        """Computes hashes of states permuted by each of `perms`, without computing permuted states themselves.
+
+        Hash of `states[j][perms[i]]` is at index `i * len(states) + j` in the result.
+        This is possible because hash is linear: hash(s[p]) = sum_k s[p[k]]*v[k] = sum_j s[j]*v[p^-1[j]].
+        """
+        assert not self.is_identity
+        states_num = states.shape[0]
+        ans = torch.empty((len(perms), states_num), dtype=torch.int64, device=states.device)
+        vecs = [[self.vec_hasher_list[k] for k in inverse_permutation(p)] for p in perms]
+        for start in range(0, states_num, self.chunk_size):
+            end = min(start + self.chunk_size, states_num)
+            states_t = states[start:end].T.contiguous()
+            for i, vec in enumerate(vecs):
+                row = ans[i, start:end]
+                row.copy_(states_t[0]).mul_(vec[0])
+                for k in range(1, self.state_size):
+                    row.add_(states_t[k], alpha=vec[k])
+        return ans.reshape(-1)
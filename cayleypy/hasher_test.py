@@ -0,0 +1,18 @@
+import pytest
+import torch
+
+from .graphs_lib import PermutationGroups
+from .hasher import StateHasher
+
+
+@pytest.mark.parametrize("chunk_size", [7, 100, 10**9])
+@pytest.mark.parametrize("dtype", [torch.uint8, torch.int16, torch.int64])
+def test_make_hashes_of_permuted(chunk_size: int, dtype: torch.dtype):
+    n = 20
+    generators = PermutationGroups.lrx(n).generators
+    hasher = StateHasher(n, 42, torch.device("cpu"), chunk_size=chunk_size)
+    max_value = min(torch.iinfo(dtype).max, 10**6)
+    states = torch.randint(0, max_value + 1, (50, n), dtype=torch.int64).to(dtype)
+    neighbors = torch.vstack([states[:, gen] for gen in generators])
+    expected = hasher.make_hashes(neighbors)
+    assert torch.equal(hasher.make_hashes_of_permuted(states, generators), expected)
@@ -73,20 +73,27 @@ class StringEncoder:
                 shift_to_mask[key] |= 1 << (start_bit % CODEWORD_LENGTH)
         return shift_to_mask
 
-    def implement_permutation(self, p: list[int]) -> Callable[[torch.Tensor, torch.Tensor], None]:
+    def implement_permutation(
+        self, p: list[int], word_major: bool = False
+    ) -> Callable[[torch.Tensor, torch.Tensor], None]:
         """Converts permutation to a function on encoded tensor implementing this permutation.
 
         This function writes result to tensor in second argument, which must be initialized to zeros.
+        If `word_major=True`, the function expects tensors of shape `(self.encoded_length, m)` instead of
+        `(m, self.encoded_length)`. In this layout each code word of all states is stored contiguously, which makes
+        bit operations much faster when `encoded_length>1`.
         """
         shift_to_mask = self.prepare_shift_to_mask(p)
+        idx = "{}" if word_major else ":,{}"
+        # Shifts are done in-place, to avoid allocating extra temporary tensors.
         lines = ["def f_(x,y):"]
         for (start_cw_id, end_cw_id, shift), mask in shift_to_mask.items():
-            line = f" y[:,{end_cw_id}] |= (x[:,{start_cw_id}] & {mask})"
+            lines.append(f" t=x[{idx.format(start_cw_id)}]&{mask}")
             if shift > 0:
-                line += f"<<{shift}"
+                lines.append(f" t<<={shift}")
             elif shift < 0:
-                line += f">>{-shift}"
-            lines.append(line)
+                lines.append(f" t>>={-shift}")
+            lines.append(f" y[{idx.format(end_cw_id)}] |= t")
         src = "\n".join(lines)
         l: dict = {}
         exec(src, {}, l)  # pylint: disable=exec-used
@@ -33,6 +33,21 @@ def test_permutation(code_width: int, n: int):
     assert torch.equal(ans, expected)
 
 
+@pytest.mark.parametrize("code_width,n", [(1, 2), (1, 5), (2, 30), (10, 100)])
+def test_permutation_word_major(code_width: int, n: int):
+    num_states = 5
+    s = torch.randint(0, 2**code_width, (num_states, n), dtype=torch.int64)
+    perm = [int(x) for x in np.random.permutation(n)]
+    expected = torch.tensor([apply_permutation(perm, row) for row in s.numpy()], dtype=torch.int64)
+    enc = StringEncoder(code_width=code_width, n=n)
+    s_encoded = enc.encode(s).T.contiguous()
+    result = torch.zeros_like(s_encoded)
+    perm_func = enc.implement_permutation(perm, word_major=True)
+    perm_func(s_encoded, result)
+    ans = enc.decode(result.T)
+    assert torch.equal(ans, expected)
+
+
 @pytest.mark.parametrize("code_width,n", [(1, 2), (1, 5), (2, 30)])
 def test_permutation_1d(code_width: int, n: int):
     num_states = 5
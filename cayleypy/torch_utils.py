@@ -6,3 +6,11 @@ def isin_via_searchsorted(elements: torch.Tensor, test_elements_sorted: torch.Te
     ts = torch.searchsorted(test_elements_sorted, elements)
     ts[ts >= len(test_elements_sorted)] = len(test_elements_sorted) - 1
     return test_elements_sorted[ts] == elements
+
+
+def smallest_int_dtype(max_value: int) -> torch.dtype:
+    """Returns the smallest integer type that can represent all numbers from 0 to `max_value`."""
+    for dtype in [torch.uint8, torch.int16, torch.int32]:
+        if max_value <= torch.iinfo(dtype).max:
+            return dtype
+    return torch.int64